@@ -0,0 +1,134 @@
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from job_store import document_hash
+from model_logic import split_offsets
+
+# 超過這個字數就寫到暫存檔，用 mmap 讀取，不常駐在 Python 記憶體
+SPILL_THRESHOLD_CHARS = 1_000_000
+# 輸入框只顯示這麼多字的預覽
+PREVIEW_CHARS = 5_000
+# 最多保留幾份文件（LRU），超過就釋放最久沒用的
+MAX_DOCUMENTS = 16
+
+
+class SentenceView:
+    """以位置切出句子的唯讀序列；需要時才從原文或 mmap 取出字串"""
+
+    def __init__(self, handle: "DocumentHandle"):
+        self._handle = handle
+
+    def __len__(self) -> int:
+        return len(self._handle.spans)
+
+    def __getitem__(self, i: int) -> str:
+        return self._handle.sentence(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._handle.sentence(i)
+
+
+class DocumentHandle:
+    """一份文件只存一次，並附上依內容 hash 算好的斷句位置"""
+
+    def __init__(self, text: str, doc_hash: str, spill_dir: str):
+        self.doc_hash = doc_hash
+        self.length = len(text)
+        self.preview = text[:PREVIEW_CHARS]
+        self.truncated = self.length > PREVIEW_CHARS
+        self.path = None
+        self._text: Optional[str] = None
+        self._file = None
+        self._mm = None
+        spans = split_offsets(text)
+        if self.length > SPILL_THRESHOLD_CHARS:
+            fd, self.path = tempfile.mkstemp(prefix=f"{doc_hash[:16]}-", suffix=".txt", dir=spill_dir)
+            with os.fdopen(fd, "wb") as f:
+                f.write(text.encode("utf-8"))
+            self._file = open(self.path, "rb")
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            # mmap 以 byte 定位，把字元位置換成 UTF-8 的 byte 位置
+            self.spans = self._byte_spans(text, spans)
+        else:
+            self._text = text
+            self.spans = spans
+
+    @staticmethod
+    def _byte_spans(text: str, spans: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        out = []
+        pos_char = pos_byte = 0
+        for start, end in spans:
+            pos_byte += len(text[pos_char:start].encode("utf-8"))
+            seg_bytes = len(text[start:end].encode("utf-8"))
+            out.append((pos_byte, pos_byte + seg_bytes))
+            pos_byte += seg_bytes
+            pos_char = end
+        return out
+
+    @property
+    def spilled(self) -> bool:
+        return self._mm is not None
+
+    def text(self) -> str:
+        if self._mm is not None:
+            return self._mm[:].decode("utf-8")
+        return self._text
+
+    def sentence(self, i: int) -> str:
+        start, end = self.spans[i]
+        if self._mm is not None:
+            return self._mm[start:end].decode("utf-8")
+        return self._text[start:end]
+
+    def sentences(self) -> SentenceView:
+        return SentenceView(self)
+
+    def discard(self) -> None:
+        """刪掉暫存檔；已開啟的 mmap 仍可讀，等沒有 session 參考時才由 GC 釋放"""
+        if self.path is not None and os.path.exists(self.path):
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class DocumentCache:
+    """以內容 hash 為 key 的文件表：同一份內容不會重複儲存或重新斷句"""
+
+    def __init__(self, spill_dir: Optional[str] = None, max_documents: int = MAX_DOCUMENTS):
+        self.spill_dir = spill_dir or tempfile.mkdtemp(prefix="detector-docs-")
+        self.max_documents = max_documents
+        self._docs: "OrderedDict[str, DocumentHandle]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, text: str, doc_hash: Optional[str] = None) -> DocumentHandle:
+        doc_hash = doc_hash or document_hash(text)
+        with self._lock:
+            if doc_hash in self._docs:
+                self._docs.move_to_end(doc_hash)
+                return self._docs[doc_hash]
+        doc = DocumentHandle(text, doc_hash, self.spill_dir)
+        with self._lock:
+            if doc_hash in self._docs:
+                # 另一個 session 同時放進同一份文件，用先到的那份
+                doc.discard()
+                return self._docs[doc_hash]
+            self._docs[doc_hash] = doc
+            while len(self._docs) > self.max_documents:
+                _, old = self._docs.popitem(last=False)
+                old.discard()
+        return doc
+
+    def get(self, doc_hash: Optional[str]) -> Optional[DocumentHandle]:
+        if not doc_hash:
+            return None
+        with self._lock:
+            doc = self._docs.get(doc_hash)
+            if doc is not None:
+                self._docs.move_to_end(doc_hash)
+            return doc
@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+_THREADS_LOCK = threading.Lock()
+# 整個 process 的 torch 執行緒預算，以及目前分享這個預算的排程器數量
+_THREAD_BUDGET: Optional[int] = None
+_SCHEDULER_COUNT = 0
+
+
+def configure_torch_threads(num_threads: Optional[int] = None) -> int:
+    """每建立一個排程器呼叫一次：把全域 torch 執行緒預算平分給所有排程器
+
+    預算只會比 torch 預設值（實體核心數）少不會多。每條推論執行緒各自跑 forward，
+    intra-op 執行緒數設成 預算 / 排程器數，中英文兩個模型同時計算時總數仍不超過預算。
+    """
+    global _THREAD_BUDGET, _SCHEDULER_COUNT
+    import torch
+    with _THREADS_LOCK:
+        if _THREAD_BUDGET is None:
+            # cpu_count() 算的是邏輯核心，不能當上限
+            limit = torch.get_num_threads()
+            if num_threads is None:
+                num_threads = int(os.environ.get("DETECTOR_TORCH_THREADS", limit))
+            _THREAD_BUDGET = max(1, min(num_threads, limit))
+            try:
+                # interop 執行緒只能在第一次平行運算前設定
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                pass
+        _SCHEDULER_COUNT += 1
+        share = max(1, _THREAD_BUDGET // _SCHEDULER_COUNT)
+        torch.set_num_threads(share)
+        return share
+
+
+class InferenceScheduler:
+    """每個模型一條推論執行緒：所有 session 共用佇列，輪流取句子湊成批次"""
+
+    def __init__(self, score_fn: Callable[[List[str]], List[float]],
+                 max_batch_size: int = 16, name: str = ""):
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.name = name
+        # session_id -> 待處理的 (文字, Future, 送入時間)
+        self._queues: "OrderedDict[str, Deque[Tuple[str, Future, float]]]" = OrderedDict()
+        self._cond = threading.Condition()
+        self._batches = 0
+        self._items = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._last_wait = 0.0
+        self._thread = threading.Thread(target=self._run, name=f"inference-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, session_id: str, texts: List[str]) -> List[Future]:
+        now = time.monotonic()
+        futures = [Future() for _ in texts]
+        with self._cond:
+            queue = self._queues.setdefault(session_id, deque())
+            for text, fut in zip(texts, futures):
+                queue.append((text, fut, now))
+            self._cond.notify()
+        return futures
+
+    def score(self, session_id: str, texts: List[str],
+              timeout: Optional[float] = None) -> List[float]:
+        return [f.result(timeout=timeout) for f in self.submit(session_id, texts)]
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            depth = sum(len(q) for q in self._queues.values())
+            return {
+                "queue_depth": depth,
+                "active_sessions": len(self._queues),
+                "batches": self._batches,
+                "items": self._items,
+                "avg_wait_ms": (self._total_wait / self._items * 1000) if self._items else 0.0,
+                "max_wait_ms": self._max_wait * 1000,
+                "last_wait_ms": self._last_wait * 1000,
+            }
+
+    def _next_batch(self) -> List[Tuple[str, Future, float]]:
+        # round-robin：每個 session 每輪只取一句，大檔案不會餓死短輸入
+        batch = []
+        while self._queues and len(batch) < self.max_batch_size:
+            session_id, queue = next(iter(self._queues.items()))
+            batch.append(queue.popleft())
+            if queue:
+                self._queues.move_to_end(session_id)
+            else:
+                del self._queues[session_id]
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queues:
+                    self._cond.wait()
+                batch = self._next_batch()
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.monotonic()
+            try:
+                scores = self.score_fn([text for text, _, _ in batch])
+            except Exception as e:
+                for _, fut, _ in batch:
+                    fut.set_exception(e)
+                continue
+            with self._cond:
+                self._batches += 1
+                for _, _, submitted in batch:
+                    wait = started - submitted
+                    self._items += 1
+                    self._total_wait += wait
+                    self._max_wait = max(self._max_wait, wait)
+                    self._last_wait = wait
+            for (_, fut, _), score in zip(batch, scores):
+                fut.set_result(score)
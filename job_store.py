@@ -0,0 +1,240 @@
+import hashlib
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Callable, Dict, Optional
+
+from model_logic import UNSCORABLE_PPL, route_models, route_sentences, split_sentences
+
+logger = logging.getLogger(__name__)
+
+# 每完成這麼多句就寫回資料庫一次，伺服器重啟後從這裡接著算
+CHECKPOINT_SENTENCES = 16
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    doc_hash TEXT NOT NULL,
+    model_name TEXT NOT NULL,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    course TEXT NOT NULL DEFAULT 'default',
+    UNIQUE (doc_hash, model_name)
+);
+CREATE TABLE IF NOT EXISTS job_scores (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    ppl REAL NOT NULL,
+    PRIMARY KEY (job_id, idx)
+);
+"""
+
+
+def document_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def scored_indices(sentences):
+    """需要送進模型的句子位置（與 UI 上色規則相同：非空白且長度 >= 2）"""
+    return [i for i, s in enumerate(sentences) if s.strip() and len(s) >= 2]
+
+
+class JobStore:
+    """SQLite 上的分析工作：狀態、進度與逐句分數"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            # 舊版資料庫沒有 course 欄位，補上
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "course" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN course TEXT NOT NULL DEFAULT 'default'")
+
+    def _connect(self) -> sqlite3.Connection:
+        # 每次操作開新連線，背景執行緒與 Streamlit 執行緒互不共用 connection
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def find_or_create(self, doc_hash: str, model_name: str, load_text: Callable[[], str],
+                       course: str = "default") -> str:
+        """course 以第一次送出時為準（同一份文件同模型只有一個 job）；只有新建 job 時才呼叫 load_text"""
+        now = time.time()
+        query = "SELECT id, status FROM jobs WHERE doc_hash = ? AND model_name = ?"
+        with self._connect() as conn:
+            row = conn.execute(query, (doc_hash, model_name)).fetchone()
+            if row is None:
+                # 兩個 session 同時送出同一份文件時，後到的 INSERT 直接被忽略，再讀回先到的那筆
+                text = load_text()
+                total = len(scored_indices(split_sentences(text)))
+                conn.execute(
+                    "INSERT OR IGNORE INTO jobs"
+                    " (id, doc_hash, model_name, text, status, total, created_at, updated_at, course)"
+                    " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+                    (uuid.uuid4().hex, doc_hash, model_name, text, total, now, now, course),
+                )
+                row = conn.execute(query, (doc_hash, model_name)).fetchone()
+            if row["status"] == "failed":
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', error = NULL, updated_at = ? WHERE id = ?",
+                    (now, row["id"]),
+                )
+            return row["id"]
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._connect() as conn:
+            # 不帶 text 欄位：UI 每次 rerun 都會輪詢，大文件不需要每次從資料庫讀出來
+            row = conn.execute(
+                "SELECT id, doc_hash, model_name, course, status, total, done, error, created_at, updated_at"
+                " FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        return dict(row) if row is not None else None
+
+    def text(self, job_id: str) -> str:
+        with self._connect() as conn:
+            return conn.execute("SELECT text FROM jobs WHERE id = ?", (job_id,)).fetchone()["text"]
+
+    def unfinished(self):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def scores(self, job_id: str) -> Dict[int, float]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT idx, ppl FROM job_scores WHERE job_id = ?", (job_id,)).fetchall()
+        return {row["idx"]: row["ppl"] for row in rows}
+
+    def save_scores(self, job_id: str, scores: Dict[int, float]) -> None:
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO job_scores (job_id, idx, ppl) VALUES (?, ?, ?)",
+                # SQLite 會把 NaN 存成 NULL；非有限值一律換成 UNSCORABLE_PPL
+                [(job_id, i, p if math.isfinite(p) else UNSCORABLE_PPL) for i, p in scores.items()],
+            )
+            conn.execute(
+                "UPDATE jobs SET done = (SELECT COUNT(*) FROM job_scores WHERE job_id = ?),"
+                " updated_at = ? WHERE id = ?",
+                (job_id, time.time(), job_id),
+            )
+
+    def set_status(self, job_id: str, status: str, error: Optional[str] = None) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id),
+            )
+
+
+class JobRunner:
+    """背景執行分析工作；啟動時自動接續資料庫裡未完成的工作"""
+
+    def __init__(self, store: JobStore, get_scheduler: Callable,
+                 result_store=None, documents=None):
+        self.store = store
+        self.get_scheduler = get_scheduler
+        self.result_store = result_store
+        # 有文件快取時直接用已算好的斷句位置，不再從 SQLite 讀全文重新斷句
+        self.documents = documents
+        self._lock = threading.Lock()
+        self._active = set()
+        for job_id in store.unfinished():
+            self._start(job_id)
+
+    def submit(self, doc_hash: str, model_name: str, load_text: Callable[[], str],
+               course: str = "default") -> str:
+        """同一份文件（同模型）只會有一個工作，重複送出會接回既有的 job"""
+        job_id = self.store.find_or_create(doc_hash, model_name, load_text, course)
+        job = self.store.get(job_id)
+        if job["status"] != "done":
+            self._start(job_id)
+        return job_id
+
+    def _start(self, job_id: str) -> None:
+        with self._lock:
+            if job_id in self._active:
+                return
+            self._active.add(job_id)
+        # 每個 job 一條執行緒，不設上限：它大部分時間只是在等排程器的結果，
+        # 真正的排隊與公平性交給排程器的 round-robin，短輸入不會卡在長文件後面
+        threading.Thread(target=self._run, args=(job_id,), name=f"job-{job_id[:8]}", daemon=True).start()
+
+    def _sentences(self, job: Dict):
+        if self.documents is None:
+            return split_sentences(self.store.text(job["id"]))
+        doc = self.documents.get(job["doc_hash"])
+        if doc is None:
+            doc = self.documents.put(self.store.text(job["id"]), job["doc_hash"])
+        return doc.sentences()
+
+    def _run(self, job_id: str) -> None:
+        try:
+            try:
+                job = self.store.get(job_id)
+                schedulers = {}
+                for lang, model_name in route_models(job["model_name"]).items():
+                    schedulers[lang] = self.get_scheduler(model_name)
+                    if schedulers[lang] is None:
+                        raise RuntimeError(f"無法載入模型 {model_name}")
+                self.store.set_status(job_id, "running")
+                sentences = self._sentences(job)
+                finished = self.store.scores(job_id)
+                targets = scored_indices(sentences)
+                # 整份文件只分一次語言，多數語言以全文為準，不受 checkpoint 切點或續跑位置影響
+                lang_of = {i: lang for lang, idx in route_sentences(sentences, targets).items() for i in idx}
+                pending = [i for i in targets if i not in finished]
+                # 所有待算句子一次送進排程器，讓它能湊滿批次；中英文各自送到自己模型的排程器，
+                # 兩條推論執行緒同時計算。以 job_id 當作 session，讓排程器在不同工作之間輪流
+                waiting = {}
+                for lang in ("zh", "en"):
+                    idx = [i for i in pending if lang_of[i] == lang]
+                    if idx:
+                        futures = schedulers[lang].submit(job_id, [sentences[i] for i in idx])
+                        waiting.update(zip(futures, idx))
+                scores = {}
+                try:
+                    while waiting:
+                        done, _ = wait(list(waiting), return_when=FIRST_COMPLETED)
+                        for fut in done:
+                            scores[waiting.pop(fut)] = fut.result()
+                        if len(scores) >= CHECKPOINT_SENTENCES or not waiting:
+                            self.store.save_scores(job_id, scores)
+                            scores = {}
+                except Exception:
+                    # 失敗時把還在排隊的句子取消，排程器會直接跳過
+                    for fut in waiting:
+                        fut.cancel()
+                    raise
+            except Exception as e:
+                self.store.set_status(job_id, "failed", str(e))
+                return
+            if self.result_store is not None:
+                try:
+                    self.result_store.append_document(job["doc_hash"], job["model_name"], sentences,
+                                                      self.store.scores(job_id), course=job["course"],
+                                                      lang_of=lang_of)
+                except Exception:
+                    # 分數都已存好，結果庫寫入失敗不影響這次分析，只記錄下來
+                    logger.exception("寫入結果庫失敗 (job %s)", job_id)
+            self.store.set_status(job_id, "done")
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+
+
+def default_db_path() -> str:
+    return os.environ.get("DETECTOR_JOB_DB", "./jobs.sqlite3")
@@ -1,12 +1,16 @@
 import streamlit as st
-import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
-import re
 import docx
 import pandas as pd
 import altair as alt
 import os
+import time
 import PyPDF2
+from model_logic import auto_model_name, compute_perplexity_batch, compute_burstiness, map_perplexity_to_ai_probability
+from inference_scheduler import InferenceScheduler, configure_torch_threads
+from job_store import JobRunner, JobStore, default_db_path
+from result_store import ResultStore, default_results_path
+from document_store import DocumentCache, PREVIEW_CHARS
 # ==========================================
 # 1. 設定與風格
 # ==========================================
@@ -72,42 +76,59 @@ def get_model_resource(model_name):
     except Exception:
         return None, None
 
-def compute_perplexity(text: str, tokenizer, model) -> float:
-    if not text.strip(): return 0.0
-    try:
-        inputs = tokenizer(text, return_tensors="pt")
-        with torch.no_grad():
-            outputs = model(**inputs, labels=inputs["input_ids"])
-            loss = outputs.loss
-        return float(torch.exp(loss).item())
-    except:
-        return 0.0
-
-def map_perplexity_to_ai_probability(ppl: float) -> int:
-    ppl_clamped = max(5.0, min(100.0, ppl))
-    ai_prob = 100 - (ppl_clamped - 5) * (90 / 95)
-    return max(5, min(95, int(round(ai_prob))))
-
-def get_highlighted_text(text: str, tokenizer, model) -> tuple[str, float]:
-    #sentences = re.split(r'(?<=[.!?。！？])\s*', text)
-    split_pattern = r'(?:(?<=[.!?。！？])\s+)|(?:\n+)'
-    sentences = re.split(split_pattern, text)
-    sentences = [s for s in sentences if s.strip()]
-    if not sentences: return "", 0.0
+@st.cache_resource
+def get_scheduler(model_name):
+    # 同一個模型只有一條推論執行緒，所有瀏覽器 session 共用
+    tokenizer, model = get_model_resource(model_name)
+    if tokenizer is None or model is None:
+        return None
+    # 每多載入一個模型，全域執行緒預算就重新平分一次
+    configure_torch_threads()
+    return InferenceScheduler(
+        lambda texts: compute_perplexity_batch(texts, tokenizer, model),
+        max_batch_size=32,
+        name=model_name,
+    )
+
+@st.cache_resource
+def get_document_cache():
+    # 文件依內容 hash 只存一份（大文件放暫存檔），rerun 不會重複複製或斷句
+    return DocumentCache()
+
+def queue_stats(schedulers):
+    # 自動模式會同時用到兩個模型的佇列
+    stats = [s.stats() for s in schedulers]
+    return {
+        "queue_depth": sum(q["queue_depth"] for q in stats),
+        "avg_wait_ms": max(q["avg_wait_ms"] for q in stats),
+        "max_wait_ms": max(q["max_wait_ms"] for q in stats),
+    }
+
+@st.cache_resource
+def get_job_runner():
+    # 背景工作存在 SQLite，伺服器重啟後會自動接續未完成的分析
+    # 完成的工作同時寫進 Parquet 結果庫，供批次統計查詢
+    return JobRunner(JobStore(default_db_path()), get_scheduler,
+                     result_store=ResultStore(default_results_path()),
+                     documents=get_document_cache())
+
+def get_highlighted_text(sentences: list[str], ppl_map: dict[int, float]) -> tuple[str, float]:
+    if not any(s.strip() for s in sentences): return "", 0.0
     
     highlighted_parts = []
     total_ai_prob = 0
     valid_count = 0
     
-    for sentence in sentences:
+    for i, sentence in enumerate(sentences):
+        if not sentence.strip():
+            continue
         # 👇 修正重點：即使是短字 (標點符號)，也要給它顏色，避免視覺斷裂
         if len(sentence) < 2:
             # 短字元直接視為上一句的屬性，或給予中性綠色
             hl = f'<span style="background-color: transparent; color: black; padding: 2px 4px; border-radius: 4px; margin: 0 2px;">{sentence}</span>'
             highlighted_parts.append(hl)
             continue
-        ppl = compute_perplexity(sentence, tokenizer, model)
-        ai_prob = map_perplexity_to_ai_probability(ppl)
+        ai_prob = map_perplexity_to_ai_probability(ppl_map[i])
         total_ai_prob += ai_prob
         valid_count += 1
         
@@ -123,6 +144,53 @@ def get_highlighted_text(text: str, tokenizer, model) -> tuple[str, float]:
     avg_prob = total_ai_prob / valid_count if valid_count > 0 else 0
     return "".join(highlighted_parts), avg_prob
 
+def load_document(job):
+    # 文件可能已被 LRU 釋放，從 SQLite 讀回全文重新放進快取
+    docs = get_document_cache()
+    return docs.get(job["doc_hash"]) or docs.put(get_job_runner().store.text(job["id"]), job["doc_hash"])
+
+@st.cache_resource(max_entries=8, ttl=3600)
+def load_report_data(job_id):
+    # 完成的 job 分數不會再變：只快取每句一個數字的分數與圖表資料，
+    # 標記 HTML 的大小跟原文一樣，不放進快取，每次顯示時再從斷句位置組出來
+    store = get_job_runner().store
+    sentences_list = load_document(store.get(job_id)).sentences()
+    # 每句的分數由背景工作算好並存在 SQLite
+    ppl_map = store.scores(job_id)
+
+    chart_data = []
+    for i, s in enumerate(sentences_list):
+        if len(s.strip()) > 1:
+            p = ppl_map[i]
+            prob = map_perplexity_to_ai_probability(p)
+
+            short_s = s[:15] + "..." if len(s) > 15 else s
+
+            # 👇👇👇 修正重點 1：直接在 Python 裡決定顏色，避開 Altair 錯誤 👇👇👇
+            if prob > 80:
+                bar_color = '#e73c7e'  # 紅 (High AI)
+            elif prob > 60:
+                bar_color = '#f59e0b'  # 黃 (Medium)
+            else:
+                bar_color = '#23d5ab'  # 綠 (Human)
+
+            chart_data.append({
+                "SentenceID": f"句 {i+1}", 
+                "Probability": int(prob), 
+                "Text": s[:80] + "..." if len(s) > 80 else s,  # tooltip 只放前 80 字，不在 DataFrame 裡複製整句
+                "Summary": short_s,
+                "BarColor": bar_color  # 把顏色存進去
+            })
+
+    burstiness = compute_burstiness(sentences_list)
+    df_chart = pd.DataFrame(chart_data) if chart_data else None
+    return ppl_map, burstiness, df_chart
+
+def build_report(job):
+    ppl_map, burstiness, df_chart = load_report_data(job["id"])
+    hl_html, avg_prob = get_highlighted_text(load_document(job).sentences(), ppl_map)
+    return hl_html, avg_prob, burstiness, df_chart
+
 # ==========================================
 # 3. UI 介面
 # ==========================================
@@ -144,11 +212,16 @@ def on_file_upload():
                 text = "\n".join([para.text for para in doc.paragraphs])
             elif filename.endswith(".pdf"):
                 reader = PyPDF2.PdfReader(uploaded)
-                for page in reader.pages:
-                    text += page.extract_text() or ""
+                # join 一次組好，避免大型 PDF 逐頁 += 反覆複製整段文字
+                text = "".join(page.extract_text() or "" for page in reader.pages)
             else:
                 text = uploaded.read().decode("utf-8")
-            st.session_state["user_text"] = text
+            # session_state 只放 hash 和預覽，完整內容交給文件快取
+            # session 直接持有 handle，文件快取淘汰它時這個 session 仍拿得到完整內容
+            handle = get_document_cache().put(text)
+            st.session_state["doc_handle"] = handle
+            st.session_state["doc_from_upload"] = True
+            st.session_state["user_text"] = handle.preview
         except Exception as e:
             st.error(f"讀取檔案失敗: {e}")
 
@@ -166,11 +239,11 @@ with c2:
     with col_opt:
         language_option = st.selectbox(
             "選擇語言模型 / Select Model",
-            ["Traditional Chinese (中文)", "English (英文)"],
+            ["Auto (中英混合自動偵測)", "Traditional Chinese (中文)", "English (英文)"],
             index=0
         )
     
-    if "Chinese" in language_option:
+    if "Chinese" in language_option or "Auto" in language_option:
         # 自動偵測本地資料夾
         if os.path.exists("./model_cn"):
             TARGET_MODEL = "./model_cn"
@@ -178,32 +251,58 @@ with c2:
         else:
             TARGET_MODEL = "uer/gpt2-chinese-cluecorpussmall"
             status_label = "🟠 中文核心 (Online)"
+        if "Auto" in language_option:
+            status_label = "🟣 自動偵測 (中文 + English)"
     else:
         TARGET_MODEL = "gpt2"
         status_label = "🔵 English Core"
+    ACTIVE_MODEL = TARGET_MODEL
 
     with col_info:
         st.markdown(f"""<div style="margin-top: 28px; background: rgba(0,0,0,0.2); color: white; padding: 8px; border-radius: 8px; text-align: center; font-weight: bold; font-size: 0.8rem;">{status_label}</div>""", unsafe_allow_html=True)
 
     # 載入模型
     with st.spinner(f"正在載入 {status_label}..."):
-        tokenizer, model = get_model_resource(TARGET_MODEL)
+        scheduler = get_scheduler(TARGET_MODEL)
     
     # 錯誤處理
-    if tokenizer is None or model is None:
-        if "Chinese" in language_option:
+    if scheduler is None:
+        if TARGET_MODEL != "gpt2":
             st.warning("⚠️ 中文模型載入失敗，切換至備援模型 (gpt2)。")
             with st.spinner("切換中..."):
-                tokenizer, model = get_model_resource("gpt2")
-        else:
+                scheduler = get_scheduler("gpt2")
+                ACTIVE_MODEL = "gpt2"
+        if scheduler is None:
+            st.error("❌ 無法載入模型。")
+            st.stop()
+
+    schedulers = [scheduler]
+    if "Auto" in language_option:
+        # 中文句子交給上面的中文模型，英文句子交給 gpt2，一次分析就能處理中英混合的文件
+        with st.spinner("正在載入 🔵 English Core..."):
+            en_scheduler = get_scheduler("gpt2")
+        if en_scheduler is None:
             st.error("❌ 無法載入模型。")
             st.stop()
+        schedulers.append(en_scheduler)
+        ACTIVE_MODEL = auto_model_name(ACTIVE_MODEL, "gpt2")
 
     st.markdown("---")
     st.file_uploader("Upload File (TXT, PDF, DOCX)", type=['txt', 'pdf', 'docx'], key="uploaded_file_key", on_change=on_file_upload)
     
     text_input = st.text_area("Paste text here", value=st.session_state["user_text"], height=250)
     final_text = text_input # 定義 final_text 變數
+    docs = get_document_cache()
+    loaded_doc = st.session_state.get("doc_handle")
+    from_upload = loaded_doc is not None and st.session_state.get("doc_from_upload", False)
+    if from_upload and loaded_doc.truncated:
+        if text_input == loaded_doc.preview:
+            st.caption(f"📄 已載入 {loaded_doc.length:,} 字的文件，上方只顯示前 {PREVIEW_CHARS:,} 字預覽；分析會使用完整內容。")
+        else:
+            st.warning(f"⚠️ 預覽內容已被修改：分析只會使用輸入框中的 {len(text_input):,} 字，原檔案第 {PREVIEW_CHARS:,} 字之後的內容（全文 {loaded_doc.length:,} 字）將不會被分析。若要分析完整檔案，請重新上傳。")
+    
+    # 結果庫依課程分區，批次統計時才能依課程比較
+    course = st.text_input("課程 / Course（選填）", placeholder="例如 CS101").strip() or "default"
     
     st.write("")
     detect_button = st.button("🔍 Start Analysis")
@@ -211,53 +310,47 @@ with c2:
 # ==========================================
 # 4. 分析結果 (絕對修復版：Python 預算顏色)
 # ==========================================
+job_runner = get_job_runner()
+
 if detect_button:
     # 處理變數可能未定義的情況
     if 'final_text' not in locals() or not final_text.strip():
         st.warning("⚠️ 請輸入內容或上傳檔案")
+    else:
+        # 同一份文件已經有工作就直接接回去，不重新計算
+        # 輸入框還是上傳檔案的預覽就用完整文件，被改過才當成新的文字
+        if not from_upload or final_text != loaded_doc.preview:
+            loaded_doc = docs.put(final_text)
+            st.session_state["doc_handle"] = loaded_doc
+            st.session_state["doc_from_upload"] = False
+        # 只有新建 job 時才需要完整文字（大文件要從 mmap 解碼），既有 job 只比對 hash
+        st.session_state["job_id"] = job_runner.submit(loaded_doc.doc_hash, ACTIVE_MODEL, loaded_doc.text, course)
+        st.session_state["job_course"] = course
+
+job = job_runner.store.get(st.session_state["job_id"]) if st.session_state.get("job_id") else None
+if job is not None:
+    if job["course"] != st.session_state.get("job_course", job["course"]):
+        # 同一份文件（同模型）只有一個 job，課程以第一次送出時為準
+        with c2:
+            st.info(f"ℹ️ 這份文件已在課程「{job['course']}」下分析過，沿用既有結果；這次輸入的課程「{st.session_state['job_course']}」不會套用。")
+    if job["status"] == "failed":
+        with c2:
+            st.error(f"❌ 分析失敗：{job['error']}")
+    elif job["status"] != "done":
+        # 分析在背景執行，重新整理或關掉分頁都不會中斷，這裡只負責輪詢進度
+        with c2:
+            q = queue_stats(schedulers)
+            st.progress(job["done"] / job["total"] if job["total"] else 0.0,
+                        text=f"Analyzing content... {job['done']} / {job['total']} 句（佇列 {q['queue_depth']} 句等待中）")
+        time.sleep(1)
+        st.rerun()
     else:
         with c2:
             with st.spinner("Analyzing content..."):
                 # ---------------------------------------------------------
                 # 1. 計算邏輯
                 # ---------------------------------------------------------
-                hl_html, avg_prob = get_highlighted_text(final_text, tokenizer, model)
-                
-                #sentences = re.split(r'(?<=[.!?。！？])\s*', final_text)
-                # ✅ 修改後的寫法 (必須跟上面函式一模一樣)
-                split_pattern = r'(?:(?<=[.!?。！？])\s+)|(?:\n+)'
-                sentences_list = re.split(split_pattern, final_text)
-                lens = [len(s.strip()) for s in sentences_list if len(s.strip()) > 1]
-                
-                chart_data = []
-                for i, s in enumerate(sentences_list):
-                    if len(s.strip()) > 1:
-                        p = compute_perplexity(s, tokenizer, model)
-                        prob = map_perplexity_to_ai_probability(p)
-                        
-                        short_s = s[:15] + "..." if len(s) > 15 else s
-                        
-                        # 👇👇👇 修正重點 1：直接在 Python 裡決定顏色，避開 Altair 錯誤 👇👇👇
-                        if prob > 80:
-                            bar_color = '#e73c7e'  # 紅 (High AI)
-                        elif prob > 60:
-                            bar_color = '#f59e0b'  # 黃 (Medium)
-                        else:
-                            bar_color = '#23d5ab'  # 綠 (Human)
-
-                        chart_data.append({
-                            "SentenceID": f"句 {i+1}", 
-                            "Probability": int(prob), 
-                            "Text": s,
-                            "Summary": short_s,
-                            "BarColor": bar_color  # 把顏色存進去
-                        })
-
-                if lens:
-                    df_len = pd.DataFrame(lens, columns=['len'])
-                    burstiness = df_len['len'].std() / df_len['len'].mean() if df_len['len'].mean() > 0 else 0
-                else:
-                    burstiness = 0
+                hl_html, avg_prob, burstiness, df_chart = build_report(job)
 
                 # ---------------------------------------------------------
                 # 2. 顯示 UI：分數卡片
@@ -292,13 +385,14 @@ if detect_button:
 </div>
 """, unsafe_allow_html=True)
                 st.caption("🔴 紅色：極高 AI 嫌疑 (>80%) | 🟡 黃色：疑似 AI (60-80%) | 🟢 綠色：人類風格 (<60%)")
+                q = queue_stats(schedulers)
+                st.caption(f"⏱️ 推論佇列：{q['queue_depth']} 句等待中 | 平均等待 {q['avg_wait_ms']:.0f} ms | 最長等待 {q['max_wait_ms']:.0f} ms")
 
                 # ---------------------------------------------------------
                 # 4. 圖表 (這裡改了！直接讀取 BarColor)
                 # ---------------------------------------------------------
-                if chart_data:
-                    df_chart = pd.DataFrame(chart_data)
-                    dynamic_h = max(300, len(chart_data) * 40)
+                if df_chart is not None:
+                    dynamic_h = max(300, len(df_chart) * 40)
                     
                     c = alt.Chart(df_chart).mark_bar(
                         cornerRadiusTopRight=10,
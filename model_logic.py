@@ -0,0 +1,146 @@
+import re
+import statistics
+from typing import Dict, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+SPLIT_PATTERN = r'(?:(?<=[.!?。！？])\s+)|(?:\n+)'
+_SPLIT_RE = re.compile(SPLIT_PATTERN)
+
+_CJK_RE = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]')
+_LATIN_RE = re.compile(r'[A-Za-z]')
+# 一個中文字的資訊量約等於一個英文單字，所以中文字佔字母類字元 1/4 以上就算中文句
+CJK_RATIO_THRESHOLD = 0.25
+# 自動模式的 model_name 形如 "auto:<中文模型>|<英文模型>"
+AUTO_PREFIX = "auto:"
+
+
+def split_sentences(text: str) -> List[str]:
+    """與原本 UI 相同的斷句規則（保留空字串，讓句子編號不變）"""
+    return re.split(SPLIT_PATTERN, text)
+
+
+def split_offsets(text: str) -> List[Tuple[int, int]]:
+    """split_sentences 每一段在原文中的 (start, end)，只存位置不複製字串"""
+    spans = []
+    start = 0
+    for m in _SPLIT_RE.finditer(text):
+        spans.append((start, m.start()))
+        start = m.end()
+    spans.append((start, len(text)))
+    return spans
+
+
+def detect_language(sentence: str) -> Optional[str]:
+    """依字元類別判斷 "zh" / "en"；沒有任何文字（純數字、標點）時回傳 None"""
+    cjk = len(_CJK_RE.findall(sentence))
+    latin = len(_LATIN_RE.findall(sentence))
+    if cjk + latin == 0:
+        return None
+    return "zh" if cjk / (cjk + latin) >= CJK_RATIO_THRESHOLD else "en"
+
+
+def route_sentences(sentences: List[str], indices: List[int]) -> Dict[str, List[int]]:
+    """把句子位置分成 zh / en 兩組（保持原本順序），無法判斷的句子跟著文件多數語言"""
+    langs = {i: detect_language(sentences[i]) for i in indices}
+    zh_count = sum(1 for lang in langs.values() if lang == "zh")
+    en_count = sum(1 for lang in langs.values() if lang == "en")
+    majority = "zh" if zh_count > en_count else "en"
+    groups: Dict[str, List[int]] = {"zh": [], "en": []}
+    for i in indices:
+        groups[langs[i] or majority].append(i)
+    return groups
+
+
+def auto_model_name(zh_model: str, en_model: str) -> str:
+    return f"{AUTO_PREFIX}{zh_model}|{en_model}"
+
+
+def route_models(model_name: str) -> Dict[str, str]:
+    """語言 -> 模型名稱；單一模型時兩種語言都用同一個"""
+    if model_name.startswith(AUTO_PREFIX):
+        zh_model, en_model = model_name[len(AUTO_PREFIX):].split("|", 1)
+        return {"zh": zh_model, "en": en_model}
+    return {"zh": model_name, "en": model_name}
+
+
+# 句子只有一個 token 時沒有可預測的下一個 token，無法算 perplexity。
+# 原本的 NaN 在 map_perplexity_to_ai_probability 會被夾到 100（顯示 10%），這裡直接給同樣的值
+UNSCORABLE_PPL = 100.0
+
+# 每次只對這麼多個 token 算 [tokens, vocab] logits，GPT-2 約 256 * 50257 * 4 bytes ≈ 51MB
+LOSS_CHUNK_TOKENS = 256
+
+
+def token_nll(model, inputs, chunk_tokens: int = LOSS_CHUNK_TOKENS):
+    """回傳 (每個 token 的 NLL, 所屬句子 index)，不產生整段序列的 logits"""
+    # 帶上 tokenizer 的所有欄位（中文 BERT tokenizer 會有 token_type_ids），與原本 model(**inputs) 一致
+    hidden = model.base_model(**inputs).last_hidden_state
+    lm_head = model.get_output_embeddings()
+    # 第 t 個位置預測第 t+1 個 token；只挑非 padding 的位置
+    mask = inputs["attention_mask"][:, 1:].bool()
+    states = hidden[:, :-1][mask]
+    labels = inputs["input_ids"][:, 1:][mask]
+    rows = mask.nonzero()[:, 0]
+    nll = torch.empty(labels.shape[0], dtype=torch.float32)
+    for start in range(0, labels.shape[0], chunk_tokens):
+        end = start + chunk_tokens
+        logits = lm_head(states[start:end]).float()
+        nll[start:end] = F.cross_entropy(logits, labels[start:end], reduction="none")
+    return nll, rows
+
+
+def _perplexities(texts: List[str], tokenizer, model) -> List[float]:
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    # 右側 padding：GPT-2 是絕對位置編碼，左側 padding 會讓分數跑掉
+    tokenizer.padding_side = "right"
+    inputs = tokenizer(texts, return_tensors="pt", padding=True)
+    with torch.no_grad():
+        nll, rows = token_nll(model, inputs)
+        total = torch.zeros(len(texts)).index_add_(0, rows, nll)
+        count = torch.zeros(len(texts)).index_add_(0, rows, torch.ones_like(nll))
+        ppl = torch.exp(total / count.clamp(min=1))
+        return torch.where(count > 0, ppl, torch.full_like(ppl, UNSCORABLE_PPL)).tolist()
+
+
+def compute_perplexity(text: str, tokenizer, model) -> float:
+    if not text.strip(): return 0.0
+    try:
+        return float(_perplexities([text], tokenizer, model)[0])
+    except:
+        return 0.0
+
+
+def compute_perplexity_batch(texts: List[str], tokenizer, model) -> List[float]:
+    """一次 forward 算多句的 perplexity，結果與逐句呼叫 compute_perplexity 相同"""
+    results = [0.0] * len(texts)
+    idx = [i for i, t in enumerate(texts) if t.strip()]
+    if not idx:
+        return results
+    try:
+        for i, ppl in zip(idx, _perplexities([texts[i] for i in idx], tokenizer, model)):
+            results[i] = float(ppl)
+    except Exception:
+        # 整批失敗（例如某句超過模型長度）就退回逐句計算，維持原本 0.0 的容錯
+        for i in idx:
+            results[i] = compute_perplexity(texts[i], tokenizer, model)
+    return results
+
+
+def compute_burstiness(sentences: List[str]) -> float:
+    """句長標準差 / 平均（樣本標準差，與 pandas std() 相同；只有一句時為 NaN）"""
+    lens = [len(s.strip()) for s in sentences if len(s.strip()) > 1]
+    if not lens:
+        return 0.0
+    if len(lens) < 2:
+        return float("nan")
+    mean = statistics.mean(lens)
+    return statistics.stdev(lens) / mean if mean > 0 else 0
+
+
+def map_perplexity_to_ai_probability(ppl: float) -> int:
+    ppl_clamped = max(5.0, min(100.0, ppl))
+    ai_prob = 100 - (ppl_clamped - 5) * (90 / 95)
+    return max(5, min(95, int(round(ai_prob))))
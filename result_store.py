@@ -0,0 +1,190 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import quote
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
+import pyarrow.parquet as pq
+
+from model_logic import compute_burstiness, map_perplexity_to_ai_probability, route_sentences
+
+# 分層合併：單一文件的小檔是第 0 層，某一層累積到這麼多個檔案就串流合併成下一層的一個檔案，
+# 每次合併只處理一組檔案，分區內檔案數約為 COMPACT_FILES * 層數
+COMPACT_FILES = 64
+COMPACTED_PREFIX = "compacted-"
+
+# 精簡型別：句子層級資料量最大，能用 int8 / float32 就不用 64 位元
+SENTENCE_SCHEMA = pa.schema([
+    ("doc_hash", pa.dictionary(pa.int32(), pa.string())),
+    ("model_name", pa.dictionary(pa.int8(), pa.string())),
+    ("sentence_idx", pa.int32()),
+    ("length", pa.int32()),
+    ("ppl", pa.float32()),
+    ("ai_prob", pa.int8()),
+    # 這句送進哪個語言的模型（"zh" / "en"）；自動模式下配合 route_models(model_name) 就知道是哪個模型算的
+    ("lang", pa.dictionary(pa.int8(), pa.string())),
+])
+
+DOCUMENT_SCHEMA = pa.schema([
+    ("doc_hash", pa.string()),
+    ("model_name", pa.dictionary(pa.int8(), pa.string())),
+    ("n_sentences", pa.int32()),
+    ("avg_prob", pa.float32()),
+    ("burstiness", pa.float32()),
+    ("scored_at", pa.timestamp("s")),
+])
+
+_SCHEMAS = {"sentences": SENTENCE_SCHEMA, "documents": DOCUMENT_SCHEMA}
+# 同一份文件可能被寫入兩次（例如寫完結果、標記完成前伺服器當掉），查詢時依這些欄位去重
+_KEYS = {
+    "sentences": ["course", "doc_hash", "model_name", "sentence_idx"],
+    "documents": ["course", "doc_hash", "model_name"],
+}
+# course 一律當字串，不讓 pyarrow 把 "101" 這種課程代碼猜成整數
+_PARTITIONING = ds.partitioning(pa.schema([("course", pa.string())]), flavor="hive")
+
+
+def _level(path: Path) -> int:
+    if not path.name.startswith(COMPACTED_PREFIX):
+        return 0
+    tag = path.name[len(COMPACTED_PREFIX):].split("-", 1)[0]
+    # 舊版的 compacted-<uuid>.parquet 視為第 1 層
+    return int(tag[1:]) if tag.startswith("L") and tag[1:].isdigit() else 1
+
+
+def _conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """依欄位名稱對齊 schema，舊檔缺少的欄位補 null"""
+    columns = [
+        table.column(field.name) if field.name in table.column_names
+        else pa.nulls(table.num_rows, field.type)
+        for field in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class ResultStore:
+    """以 course 分區的 Parquet 結果庫：sentences/ 與 documents/ 兩張表"""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        # 背景工作會同時寫入；寫檔與合併要互斥，避免合併時漏掉剛寫好的檔案
+        self._lock = threading.Lock()
+
+    def _partition(self, table: str, course: str) -> Path:
+        part = self.root / table / f"course={quote(course, safe='')}"
+        part.mkdir(parents=True, exist_ok=True)
+        return part
+
+    def _part_path(self, table: str, course: str, doc_hash: str, model_name: str) -> Path:
+        # 合併前同一份文件 + 模型固定寫到同一個檔案，重寫會覆蓋；已合併後再寫入會留下重複列，由查詢時去重
+        model_tag = hashlib.sha1(model_name.encode("utf-8")).hexdigest()[:8]
+        return self._partition(table, course) / f"{doc_hash}-{model_tag}.parquet"
+
+    @staticmethod
+    def _files_at(part: Path, level: int) -> List[Path]:
+        return sorted(p for p in part.glob("*.parquet") if _level(p) == level)
+
+    def compact(self, table: str, course: str, level: int = 0) -> None:
+        """把某一層的檔案串流合併成下一層的一個檔案，一次只載入一個 row group"""
+        part = self._partition(table, course)
+        files = self._files_at(part, level)
+        if len(files) < 2:
+            return
+        schema = _SCHEMAS[table]
+        tmp = part / f".{uuid.uuid4().hex}.tmp"
+        with pq.ParquetWriter(tmp, schema) as writer:
+            for f in files:
+                pf = pq.ParquetFile(f, memory_map=True)
+                for i in range(pf.num_row_groups):
+                    writer.write_table(_conform(pf.read_row_group(i), schema))
+        # 以 . 開頭的暫存檔不會被讀到；改名後才算正式寫入，再刪掉原本的檔案
+        tmp.rename(part / f"{COMPACTED_PREFIX}L{level + 1}-{uuid.uuid4().hex}.parquet")
+        for f in files:
+            f.unlink()
+
+    def append_document(self, doc_hash: str, model_name: str, sentences: List[str],
+                        ppl_map: Dict[int, float], course: str = "default",
+                        lang_of: Optional[Dict[int, str]] = None) -> None:
+        """lang_of 是句子位置 -> 語言，沒給時依全文重新判斷"""
+        idx = sorted(ppl_map)
+        if lang_of is None:
+            lang_of = {i: lang for lang, group in route_sentences(sentences, idx).items() for i in group}
+        probs = [map_perplexity_to_ai_probability(ppl_map[i]) for i in idx]
+        sentence_table = pa.table({
+            "doc_hash": pa.array([doc_hash] * len(idx)).dictionary_encode(),
+            "model_name": pa.array([model_name] * len(idx)),
+            "sentence_idx": idx,
+            "length": [len(sentences[i].strip()) for i in idx],
+            "ppl": [ppl_map[i] for i in idx],
+            "ai_prob": probs,
+            "lang": [lang_of[i] for i in idx],
+        }).cast(SENTENCE_SCHEMA)
+        document_table = pa.table({
+            "doc_hash": [doc_hash],
+            "model_name": [model_name],
+            "n_sentences": [len(idx)],
+            "avg_prob": [sum(probs) / len(probs) if probs else 0.0],
+            "burstiness": [compute_burstiness(sentences)],
+            "scored_at": pa.array([int(time.time())], pa.timestamp("s")),
+        }).cast(DOCUMENT_SCHEMA)
+        with self._lock:
+            for table, data in (("sentences", sentence_table), ("documents", document_table)):
+                pq.write_table(data, self._part_path(table, course, doc_hash, model_name))
+            # 兩張表都寫完才合併：中途當掉重跑時，小檔還沒被合併，會直接覆蓋
+            for table in ("sentences", "documents"):
+                part = self._partition(table, course)
+                level = 0
+                while len(self._files_at(part, level)) >= COMPACT_FILES:
+                    self.compact(table, course, level)
+                    level += 1
+
+    def read(self, table: str, columns: Optional[List[str]] = None, filters=None) -> pa.Table:
+        """只讀需要的欄位（memory-map），filters 例如 [("course", "=", "cs101")]"""
+        path = self.root / table
+        schema = _SCHEMAS[table].append(pa.field("course", pa.string()))
+        if not path.exists():
+            return schema.empty_table().select(columns) if columns else schema.empty_table()
+        # 指定完整 schema：course 固定是字串，舊檔缺少的欄位讀成 null
+        dataset = ds.dataset(str(path), schema=schema, format="parquet", partitioning=_PARTITIONING,
+                             filesystem=pafs.LocalFileSystem(use_mmap=True))
+        expression = pq.filters_to_expression(filters) if filters else None
+        return dataset.to_table(columns=columns, filter=expression)
+
+    def read_frame(self, table: str, columns: List[str], filters=None) -> pd.DataFrame:
+        """讀成 DataFrame，並去掉同一份文件重複寫入的列（內容相同，留一筆）"""
+        keys = _KEYS[table]
+        df = self.read(table, list(dict.fromkeys(keys + columns)), filters).to_pandas()
+        return df.drop_duplicates(subset=keys)[columns].reset_index(drop=True)
+
+    def probability_distribution(self, course: Optional[str] = None, bins: int = 10) -> pd.DataFrame:
+        """每個 course 的句子 AI 機率分布（每 100 / bins 個百分點一格）"""
+        filters = [("course", "=", course)] if course else None
+        df = self.read_frame("sentences", ["course", "ai_prob"], filters)
+        width = 100 // bins
+        df["bin"] = (df["ai_prob"].astype("int16") // width * width).clip(upper=100 - width)
+        return (df.groupby(["course", "bin"], observed=True).size()
+                  .rename("count").reset_index())
+
+    def top_documents(self, n: int = 10, course: Optional[str] = None) -> pd.DataFrame:
+        filters = [("course", "=", course)] if course else None
+        df = self.read_frame("documents", ["course", "doc_hash", "model_name", "avg_prob", "n_sentences"],
+                             filters)
+        return df.nlargest(n, "avg_prob").reset_index(drop=True)
+
+    def burstiness_trend(self, freq: str = "D") -> pd.DataFrame:
+        """各 course 在每個時間區間的平均 burstiness"""
+        df = self.read_frame("documents", ["course", "scored_at", "burstiness"])
+        df["period"] = df["scored_at"].dt.to_period(freq).dt.start_time
+        return (df.groupby(["course", "period"], observed=True)["burstiness"]
+                  .mean().reset_index())
+
+
+def default_results_path() -> str:
+    return os.environ.get("DETECTOR_RESULTS_DIR", "./results")